@@ -30,8 +30,16 @@ author: "Jose Armesto (@fiunchinho)"
 options:
   name:
     description:
-      - Cluster name to be used.
-    required: true
+      - Cluster name to be used. Either C(name) or C(names) is required.
+    required: false
+  names:
+    description:
+      - List of cluster names to be created or updated with the same configuration. Domains are reconciled concurrently
+        and duplicate names are ignored. When used, the module returns a C(responses) dict keyed by cluster name instead
+        of C(response). If some domains fail, the module fails with the errors of each of them, and C(responses) still
+        holds the domains that succeeded.
+    required: false
+    type: list
   elasticsearch_version:
     description:
       - Elasticsearch version to deploy. Default is '2.3'.
@@ -43,24 +51,28 @@ options:
     aliases: ['aws_region', 'ec2_region']
   instance_type:
     description:
-      - Type of the instances to use for the cluster. Valid types are: 'm3.medium.elasticsearch'|'m3.large.elasticsearch'|'m3.xlarge.elasticsearch'|'m3.2xlarge.elasticsearch'|'t2.micro.elasticsearch'|'t2.small.elasticsearch'|'t2.medium.elasticsearch'|'r3.large.elasticsearch'|'r3.xlarge.elasticsearch'|'r3.2xlarge.elasticsearch'|'r3.4xlarge.elasticsearch'|'r3.8xlarge.elasticsearch'|'i2.xlarge.elasticsearch'|'i2.2xlarge.elasticsearch'
+      - "Type of the instances to use for the cluster. Valid types are: 'm3.medium.elasticsearch'|'m3.large.elasticsearch'|'m3.xlarge.elasticsearch'|'m3.2xlarge.elasticsearch'|'t2.micro.elasticsearch'|'t2.small.elasticsearch'|'t2.medium.elasticsearch'|'r3.large.elasticsearch'|'r3.xlarge.elasticsearch'|'r3.2xlarge.elasticsearch'|'r3.4xlarge.elasticsearch'|'r3.8xlarge.elasticsearch'|'i2.xlarge.elasticsearch'|'i2.2xlarge.elasticsearch'"
     required: true
   instance_count:
     description:
       - Number of instances for the cluster.
     required: true
+    type: int
   dedicated_master:
     description:
       - A boolean value to indicate whether a dedicated master node is enabled.
     required: true
+    type: bool
   zone_awareness:
     description:
       - A boolean value to indicate whether zone awareness is enabled.
     required: true
+    type: bool
   ebs:
     description:
       - Specifies whether EBS-based storage is enabled.
     required: true
+    type: bool
   dedicated_master_instance_type:
     description:
       - The instance type for a dedicated master node.
@@ -69,6 +81,7 @@ options:
     description:
       - Total number of dedicated master nodes, active and on standby, for the cluster.
     required: false
+    type: int
   volume_type:
     description:
       - Specifies the volume type for EBS-based storage.
@@ -77,22 +90,27 @@ options:
     description:
       - Integer to specify the size of an EBS volume.
     required: true
+    type: int
   vpc_subnets:
     description:
-      - Specifies the subnet ids for VPC endpoint.
+      - List of subnet ids for VPC endpoint. A comma separated string is also accepted.
     required: false
+    type: list
   vpc_security_groups:
     description:
-      - Specifies the security group ids for VPC endpoint.
+      - List of security group ids for VPC endpoint. A comma separated string is also accepted.
     required: false
+    type: list
   snapshot_hour:
     description:
       - Integer value from 0 to 23 specifying when the service takes a daily automated snapshot of the specified Elasticsearch domain.
     required: true
+    type: int
   access_policies:
     description:
       - IAM access policy as a JSON-formatted string.
     required: true
+    type: dict
   profile:
     description:
       - What Boto profile use to connect to AWS.
@@ -101,14 +119,18 @@ options:
     description:
       - Should data be encrypted while at rest.
     required: false
+    type: bool
   encryption_at_rest_kms_key_id:
     description:
-      - If encryption_at_rest_enabled is True, this identifies the encryption key to use 
+      - If encryption_at_rest_enabled is True, this identifies the encryption key to use. Defaults to the AWS managed key.
     required: false
-    
+
 requirements:
   - "python >= 2.6"
   - boto3
+  - a botocore release supporting tcp_keepalive and retry modes (optional, older releases keep the default connection and retry behaviour)
+  - futures (on python 2, to reconcile C(names) concurrently)
+  - orjson (optional, speeds up access policy serialization)
 """
 
 EXAMPLES = '''
@@ -131,20 +153,218 @@ EXAMPLES = '''
     snapshot_hour: 13
     access_policies: "{{ lookup('file', 'files/cluster_policies.json') | from_json }}"
     profile: "myawsaccount"
+
+- ec2_elasticsearch:
+    names:
+      - "my-cluster-a"
+      - "my-cluster-b"
+    region: "eu-west-1"
+    instance_type: "m3.medium.elasticsearch"
+    instance_count: 2
+    dedicated_master: False
+    zone_awareness: False
+    ebs: True
+    volume_type: "standard"
+    volume_size: 10
+    snapshot_hour: 13
+    access_policies: "{{ lookup('file', 'files/cluster_policies.json') | from_json }}"
 '''
+import copy
+
+# Policies are (de)serialized with orjson when available, falling back to the
+# standard library. Both produce the same canonical form: sorted keys, no
+# whitespace.
 try:
-    import botocore
-    import boto3
+    import orjson
+
+    def _dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+
+    _loads = orjson.loads
+except ImportError:
     import json
 
-    HAS_BOTO=True
+    def _dumps(data):
+        return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+    _loads = json.loads
+
+# boto3 is only imported once the arguments have been parsed, see
+# _ensure_boto(). The flag is private so that the module_utils.ec2 star
+# import at the bottom of this file, which exports its own HAS_BOTO for the
+# legacy boto library, cannot shadow it.
+_HAS_BOTO3 = None
+
+def _ensure_boto():
+    global boto3, botocore, _HAS_BOTO3
+    if _HAS_BOTO3 is not None:
+        return _HAS_BOTO3
+    try:
+        import botocore
+        import botocore.config
+        import botocore.exceptions
+        import boto3
+
+        _HAS_BOTO3 = True
+    except ImportError:
+        _HAS_BOTO3 = False
+    return _HAS_BOTO3
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+
+    HAS_FUTURES=True
 except ImportError:
-    HAS_BOTO=False
+    HAS_FUTURES=False
+
+# Upper bound on concurrent domain reconciliations when `names` is used.
+MAX_WORKERS = 16
+
+# Clients are reused across calls within the same process, keyed by the
+# credentials identity, so botocore only loads the service model and resolves
+# the endpoint once.
+_CLIENT_CACHE = {}
+
+def _client_config():
+    # boto3 clients are thread safe; the connection pool is big enough to
+    # serve every worker at once, and idle connections are kept alive so
+    # later calls skip the TCP and TLS handshakes.
+    pool_options = dict(max_pool_connections=50, connect_timeout=5, read_timeout=60)
+    try:
+        return botocore.config.Config(
+            tcp_keepalive=True,
+            retries={'mode': 'adaptive', 'max_attempts': 5},
+            **pool_options
+        )
+    except (TypeError, botocore.exceptions.BotoCoreError):
+        # Older botocore releases know neither tcp_keepalive nor retry modes,
+        # keep their default retry behaviour
+        return botocore.config.Config(**pool_options)
+
+def _get_es_client(module, region, aws_connect_params):
+    key = (region, aws_connect_params.get('aws_access_key_id'), aws_connect_params.get('profile_name'))
+    client = _CLIENT_CACHE.get(key)
+    if client is None:
+        client = boto3_conn(module=module, conn_type='client', resource='es', region=region, config=_client_config(), **aws_connect_params)
+        _CLIENT_CACHE[key] = client
+    return client
+
+def _subset_equal(desired, actual):
+    # AWS returns more settings than the ones this module manages, so only
+    # the keys we set are compared
+    return all(actual.get(key) == value for key, value in desired.items())
+
+def _domain_error(name, e):
+    return 'Error on domain %s: %s %s' % (name, str(e.response['Error']['Code']), str(e.response['Error']['Message']))
+
+def ensure_domain(client, name, domain_options, access_policies, policy_doc):
+    """
+    Creates the domain `name` or updates it if its configuration differs from
+    `domain_options`. `policy_doc` is the canonical serialization of
+    `access_policies`. Returns a (changed, response) tuple, where response
+    comes from the create/update call when the domain changed.
+    """
+    changed = False
+    pdoc = policy_doc
+
+    cluster_config = domain_options['ElasticsearchClusterConfig']
+    ebs_options = domain_options['EBSOptions']
+    vpc_options = domain_options['VPCOptions']
+    snapshot_options = domain_options['SnapshotOptions']
+    encryption_at_rest_options = domain_options['EncryptionAtRestOptions']
+
+    try:
+        response = client.describe_elasticsearch_domain(DomainName=name)
+        status = response['DomainStatus']
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        status = None
+
+    if status is not None and any('Resource' not in statement for statement in access_policies['Statement']):
+        # Modify the provided policy to provide reliable changed detection.
+        # The ES APIs will implicitly set this resource on every statement
+        # that lacks one. Every domain gets its own copy, as the resource
+        # depends on the domain ARN.
+        domain_resource = '%s/*' % status['ARN']
+        policy_dict = copy.deepcopy(access_policies)
+        for statement in policy_dict['Statement']:
+            if 'Resource' not in statement:
+                statement['Resource'] = domain_resource
+        pdoc = _dumps(policy_dict)
+
+    if status is None:
+        changed = True
+
+        keyword_args = {
+            'DomainName': name,
+            'ElasticsearchVersion': domain_options['ElasticsearchVersion'],
+            'EncryptionAtRestOptions': encryption_at_rest_options,
+            'ElasticsearchClusterConfig': cluster_config,
+            'EBSOptions': ebs_options,
+            'SnapshotOptions': snapshot_options,
+            'AccessPolicies': pdoc,
+        }
+
+        if vpc_options['SubnetIds'] or vpc_options['SecurityGroupIds']:
+            keyword_args['VPCOptions'] = vpc_options
+
+        response = client.create_elasticsearch_domain(**keyword_args)
+
+    else:
+        if not _subset_equal(cluster_config, status['ElasticsearchClusterConfig']):
+            changed = True
+
+        if not _subset_equal(ebs_options, status['EBSOptions']):
+            changed = True
+
+        # Only the VPC options that were supplied are compared; AWS fills in
+        # the rest, for example the default security group
+        desired_vpc_options = dict((key, value) for key, value in vpc_options.items() if value)
+        if desired_vpc_options and 'VPCOptions' in status:
+            if not _subset_equal(desired_vpc_options, status['VPCOptions']):
+                changed = True
+
+        if not _subset_equal(snapshot_options, status['SnapshotOptions']):
+            changed = True
+
+        # Encryption at rest can only be turned on for an existing domain, never
+        # off, and AWS reports the key as a full ARN. Only a request to enable
+        # it on an unencrypted domain counts as drift. Domains created without
+        # encryption may not report these options at all.
+        current_encryption = status.get('EncryptionAtRestOptions') or {}
+        encryption_changed = encryption_at_rest_options['Enabled'] and not current_encryption.get('Enabled')
+        if encryption_changed:
+            changed = True
+
+        current_canonical = _dumps(_loads(status['AccessPolicies']))
+        if current_canonical != pdoc:
+            changed = True
+
+        if changed:
+            keyword_args = {
+                'DomainName': name,
+                'ElasticsearchClusterConfig': cluster_config,
+                'EBSOptions': ebs_options,
+                'SnapshotOptions': snapshot_options,
+                'AccessPolicies': pdoc,
+            }
+
+            if vpc_options['SubnetIds'] or vpc_options['SecurityGroupIds']:
+                keyword_args['VPCOptions'] = vpc_options
+
+            if encryption_changed:
+                keyword_args['EncryptionAtRestOptions'] = encryption_at_rest_options
+
+            response = client.update_elasticsearch_domain_config(**keyword_args)
+
+    return changed, response
 
 def main():
     argument_spec = ec2_argument_spec()
     argument_spec.update(dict(
-            name = dict(required=True),
+            name = dict(),
+            names = dict(type='list', elements='str'),
             instance_type = dict(required=True),
             instance_count = dict(required=True, type='int'),
             dedicated_master = dict(required=True, type='bool'),
@@ -155,27 +375,29 @@ def main():
             volume_type = dict(required=True),
             volume_size = dict(required=True, type='int'),
             access_policies = dict(required=True, type='dict'),
-            vpc_subnets = dict(required=False),
-            vpc_security_groups = dict(required=False),
+            vpc_subnets = dict(required=False, type='list', elements='str'),
+            vpc_security_groups = dict(required=False, type='list', elements='str'),
             snapshot_hour = dict(required=True, type='int'),
             elasticsearch_version = dict(default='2.3'),
-            encryption_at_rest_enabled = dict(default=False),
+            encryption_at_rest_enabled = dict(default=False, type='bool'),
             encryption_at_rest_kms_key_id = dict(required=False),
     ))
 
     module = AnsibleModule(
             argument_spec=argument_spec,
+            required_one_of=[['name', 'names']],
+            mutually_exclusive=[['name', 'names']],
     )
 
-    if not HAS_BOTO:
+    if not _ensure_boto():
         module.fail_json(msg='boto3 required for this module, install via pip or your package manager')
 
     region, ec2_url, aws_connect_params = get_aws_connection_info(module, True)
-    client = boto3_conn(module=module, conn_type='client', resource='es', region=region, **aws_connect_params)
+    client = _get_es_client(module, region, aws_connect_params)
 
     cluster_config = {
            'InstanceType': module.params.get('instance_type'),
-           'InstanceCount': int(module.params.get('instance_count')),
+           'InstanceCount': module.params.get('instance_count'),
            'DedicatedMasterEnabled': module.params.get('dedicated_master'),
            'ZoneAwarenessEnabled': module.params.get('zone_awareness')
     }
@@ -184,21 +406,18 @@ def main():
            'EBSEnabled': module.params.get('ebs')
     }
 
-    encryption_at_rest_enabled = module.params.get('encryption_at_rest_enabled') == 'True'
+    encryption_at_rest_enabled = module.params.get('encryption_at_rest_enabled')
     encryption_at_rest_options = {
         'Enabled': encryption_at_rest_enabled
     }
 
-    if encryption_at_rest_enabled:
+    if encryption_at_rest_enabled and module.params.get('encryption_at_rest_kms_key_id'):
         encryption_at_rest_options['KmsKeyId'] = module.params.get('encryption_at_rest_kms_key_id')
 
-    vpc_options = {}
-
-    if module.params.get('vpc_subnets'):
-        vpc_options['SubnetIds'] = [x.strip() for x in module.params.get('vpc_subnets').split(',')]
-
-    if module.params.get('vpc_security_groups'):
-        vpc_options['SecurityGroupIds'] = [x.strip() for x in module.params.get('vpc_security_groups').split(',')]
+    vpc_options = {
+        'SubnetIds': [x.strip() for x in module.params.get('vpc_subnets') or []],
+        'SecurityGroupIds': [x.strip() for x in module.params.get('vpc_security_groups') or []],
+    }
 
     if cluster_config['DedicatedMasterEnabled']:
         cluster_config['DedicatedMasterType'] = module.params.get('dedicated_master_instance_type')
@@ -212,83 +431,72 @@ def main():
         'AutomatedSnapshotStartHour': module.params.get('snapshot_hour')
     }
 
-    changed = False
+    domain_options = {
+        'ElasticsearchVersion': module.params.get('elasticsearch_version'),
+        'EncryptionAtRestOptions': encryption_at_rest_options,
+        'ElasticsearchClusterConfig': cluster_config,
+        'EBSOptions': ebs_options,
+        'VPCOptions': vpc_options,
+        'SnapshotOptions': snapshot_options,
+    }
+
+    access_policies = module.params.get('access_policies')
 
     try:
-        pdoc = json.dumps(module.params.get('access_policies'))
+        pdoc = _dumps(access_policies)
     except Exception as e:
         module.fail_json(msg='Failed to convert the policy into valid JSON: %s' % str(e))
 
-    try:
-        response = client.describe_elasticsearch_domain(DomainName=module.params.get('name'))
-        status = response['DomainStatus']
-
-        # Modify the provided policy to provide reliable changed detection
-        policy_dict = module.params.get('access_policies')
-        for statement in policy_dict['Statement']:
-            if 'Resource' not in statement:
-                # The ES APIs will implicitly set this
-                statement['Resource'] = '%s/*' % status['ARN']
-                pdoc = json.dumps(policy_dict)
-
-        if status['ElasticsearchClusterConfig'] != cluster_config:
-            changed = True
-
-        if status['EBSOptions'] != ebs_options:
-            changed = True
-
-        if 'VPCOptions' in status:
-            if status['VPCOptions']['SubnetIds'] != vpc_options['SubnetIds']:
-                changed = True
-            if status['VPCOptions']['SecurityGroupIds'] != vpc_options['SecurityGroupIds']:
-                changed = True
-
-        if status['SnapshotOptions'] != snapshot_options:
-            changed = True
-
-        current_policy_dict = json.loads(status['AccessPolicies'])
-        if current_policy_dict != policy_dict:
-            changed = True
-
+    if module.params.get('names') is None:
+        names = [module.params.get('name')]
+    else:
+        # Reconciling the same domain twice concurrently would race, so
+        # duplicates are dropped while keeping the given order
+        names = []
+        for name in module.params.get('names'):
+            if name not in names:
+                names.append(name)
+
+        if not names:
+            module.fail_json(msg='names must contain at least one cluster name')
+
+    def ensure(name):
+        # Errors are collected per domain so one failure does not hide the
+        # outcome of the others. Returns a (changed, response, error) tuple.
+        try:
+            changed, response = ensure_domain(client, name, domain_options, access_policies, pdoc)
+        except botocore.exceptions.ClientError as e:
+            return False, None, _domain_error(name, e)
+
+        # Retrieve response from describe, as create/update differ in their response format.
+        # When nothing changed, the initial describe response is still current.
         if changed:
-            keyword_args = {
-                'DomainName': module.params.get('name'),
-                'ElasticsearchClusterConfig': cluster_config,
-                'EBSOptions': ebs_options,
-                'SnapshotOptions': snapshot_options,
-                'AccessPolicies': pdoc,
-            }
-
-            if vpc_options['SubnetIds'] or vpc_options['SecurityGroupIds']:
-                keyword_args['VPCOptions'] = vpc_options
+            try:
+                response = client.describe_elasticsearch_domain(DomainName=name)
+            except botocore.exceptions.ClientError as e:
+                return True, None, _domain_error(name, e)
 
-            response = client.update_elasticsearch_domain_config(**keyword_args)
+        return changed, response, None
 
-    except botocore.exceptions.ClientError as e:
-        changed = True
-
-        if e.response['Error']['Code'] == 'ResourceNotFoundException':
-            keyword_args = {
-                'DomainName': module.params.get('name'),
-                'ElasticsearchVersion': module.params.get('elasticsearch_version'),
-                'EncryptionAtRestOptions': encryption_at_rest_options,
-                'ElasticsearchClusterConfig': cluster_config,
-                'EBSOptions': ebs_options,
-                'SnapshotOptions': snapshot_options,
-                'AccessPolicies': pdoc,
-            }
+    if len(names) > 1 and HAS_FUTURES:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(names))) as executor:
+            results = list(executor.map(ensure, names))
+    else:
+        results = [ensure(name) for name in names]
 
-            if vpc_options['SubnetIds'] or vpc_options['SecurityGroupIds']:
-                keyword_args['VPCOptions'] = vpc_options
+    changed = any(result[0] for result in results)
+    errors = [result[2] for result in results if result[2] is not None]
 
-            response = client.create_elasticsearch_domain(**keyword_args)
+    if module.params.get('names') is not None:
+        responses = dict((name, result[1]) for name, result in zip(names, results) if result[2] is None)
+        if errors:
+            module.fail_json(msg='; '.join(errors), changed=changed, responses=responses)
+        module.exit_json(changed=changed, responses=responses)
 
-        else:
-            module.fail_json(msg='Error: %s %s' % (str(e.response['Error']['Code']), str(e.response['Error']['Message'])),)
+    if errors:
+        module.fail_json(msg=errors[0], changed=changed)
 
-    # Retrieve response from describe, as create/update differ in their response format
-    response = client.describe_elasticsearch_domain(DomainName=module.params.get('name'))
-    module.exit_json(changed=changed, response=response)
+    module.exit_json(changed=changed, response=results[0][1])
 
 # import module snippets
 from ansible.module_utils.basic import *